@@ -2,12 +2,18 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import pingouin as pg
 import os
+import math
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from scipy.optimize import curve_fit
 from scipy.stats import linregress
 from scipy.stats import multivariate_normal
 from scipy import signal
 from scipy.stats import norm
 from scipy.stats import binom
+from scipy.stats import ttest_rel
 from scipy.optimize import differential_evolution, LinearConstraint
+from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
@@ -50,277 +50,396 @@ The script contains a manual "day exclusion list" and several subject-specific f
 from imports import *
 from util_func_dbm import *
 
-if __name__ == '__main__':
-
-    # NOTE: Init figure style
-    sns.set_palette("rocket", n_colors=4)
-    plt.rc('axes', labelsize=14)
-    plt.rc('xtick', labelsize=12)
-    plt.rc('ytick', labelsize=12)
-
-    dir_data = "../data"
-    dir_data_lab_beh = "../data_lab_behave"
-
-    df_train_rec = []  # training days
-    df_bs_rec = []  # button switch days
-    df_dt_rec = []  # dual task days
-    df_lab_rec = []  # lab days
+# NOTE: the only trial-level columns used downstream (the remaining
+#       stroop and stimulus columns are never read)
+READ_COLUMNS = [
+    'subject', 'day', 'trial', 'cat', 'x', 'y', 'resp', 'rt',
+    'ns_correct_side', 'ns_resp'
+]
+
+# 1. sub 002 has an at home day labelled day 23
+#    that was also the 17th at home day
+#    (i.e., an extra day)
+# 2. sub 008 did four extra days
+#    they didn't understand EEG days counted
+# 3. sub 015 missed 2 at home days, therefore,
+#    excluding days 22, 23, 24
+# 4. sub 019 did 2 extra days. Day 13 froze their
+#    computer during the task (84 trials completed).
+#    They continued with the next day instead
+#    of re-doing day 13. So, D13 is unusable and
+#    will be excluded here. Will also exclude day 18,
+#    because it is an extra at home day.
+#
+# NOTE: Day Exclusion List (at-home files, keyed by file name)
+EXCLUDE_FILES = {
+    'sub_002_day_23_data.csv',  # extra at home day
+    'sub_008_day_18_data.csv',  # extra at home day
+    'sub_008_day_19_data.csv',  # extra at home day
+    'sub_008_day_20_data.csv',  # extra at home day
+    'sub_008_day_21_data.csv',  # extra at home day
+    'sub_008_day_22_data.csv',  # exclude DT
+    'sub_008_day_23_data.csv',  # exclude BS
+    'sub_008_day_24_data.csv',  # exclue BS
+    'sub_015_day_22_data.csv',  # exclude DT
+    'sub_015_day_23_data.csv',  # exclude BS
+    'sub_015_day_24_data.csv',  # exclude BS
+    'sub_019_day_13_data.csv',  # computer froze
+    'sub_019_day_18_data.csv',  # exclude DT
+    'sub_019_day_22_data.csv',  # exclude BS
+    'sub_019_day_23_data.csv',  # exclude BS
+    'sub_019_day_24_data.csv',  # extra at home day
+}
+
+# NOTE: subject fixes for mislabeled at-home files, keyed by file name
+FIX_SUBJECT = {
+    # sub_006 mislabeled days 22, 23, and 24 as sub_001
+    # manually change file name to: sub_006_day_22_data.csv,
+    # sub_006_day_23_data.csv, sub_006_day_24_data.csv
+    'sub_006_day_22_data.csv': 6,
+    'sub_006_day_23_data.csv': 6,
+    'sub_006_day_24_data.csv': 6,
+
+    # fix sub_015 mislabeling in raw data
+    # also fix extra 1 in day 7 (trial 60 or 61) manually
+    'sub_015_day_01_data.csv': 15,
+
+    # sub_016 mislabeled day 22 as sub_001 and had already
+    # changed file name to: sub_016_day_22_data.csv
+    # changing from subject 1 to subject 16
+    'sub_016_day_22_data.csv': 16,
+
+    # sub_017 day 17 mislabeled to sub_007_day_17_data.csv
+    # manually change file name to: sub_017_day_17_data.csv
+    'sub_017_day_17_data.csv': 17,
+
+    # sub_019 mislabeled day 1 as sub_001
+    # no need to manually change file name
+    'sub_019_day_01_data.csv': 19,
+}
+
+# NOTE: day fixes for mislabeled at-home files, keyed by file name
+FIX_DAY = {
+    # sub_003 somehow replicated day 18
+    'sub_003_day_19_data.csv': 19,
+    'sub_003_day_20_data.csv': 20,
+
+    # from trial 276 on day 24, 'day' changes to day 25
+    # (until the end of the expt)
+    # also, in this file there are 4 lines of ,,,,,,,,,,,
+    # after the end of the experiment
+    # manually removed those lines
+    'sub_019_day_24_data.csv': 24,
+}
+
+# NOTE: day fixes for mislabeled lab files, keyed by file name
+FIX_DAY_LAB = {
+    # mislabelled sub_003_day_401_data.csv
+    # manually changed file name to: sub_003_day_403_data.csv
+    'sub_003_day_401_data.csv': 403,
+
+    # mislabelled sub_015_day_15_data.csv
+    # manually changed file name to: sub_015_day_215_data.csv
+    'sub_015_day_15_data.csv': 215,
+}
+
+
+def iter_home_csvs(dir_data):
+    """
+    Yield the path of every at-home CSV (dir_data/<subj folder>/<file>)
+    that is not on the day exclusion list.
+    """
 
     for fd in os.listdir(dir_data):
         dir_data_fd = os.path.join(dir_data, fd)
         if os.path.isdir(dir_data_fd):
             for fs in os.listdir(dir_data_fd):
                 f_full_path = os.path.join(dir_data_fd, fs)
-                if os.path.isfile(f_full_path):
-
-                    # 1. sub 002 has an at home day labelled day 23
-                    #    that was also the 17th at home day
-                    #    (i.e., an extra day)
-                    # 2. sub 008 did four extra days
-                    #    they didn't understand EEG days counted
-                    # 3. sub 015 missed 2 at home days, therefore,
-                    #    excluding days 22, 23, 24
-                    # 4. sub 019 did 2 extra days. Day 13 froze their
-                    #    computer during the task (84 trials completed).
-                    #    They continued with the next day instead
-                    #    of re-doing day 13. So, D13 is unusable and
-                    #    will be excluded here. Will also exclude day 18,
-                    #    because it is an extra at home day.
-                    #
-                    # NOTE: Day Exclusion List
-                    if fs not in [
-                            'sub_002_day_23_data.csv',  # extra at home day
-                            'sub_008_day_18_data.csv',  # extra at home day
-                            'sub_008_day_19_data.csv',  # extra at home day
-                            'sub_008_day_20_data.csv',  # extra at home day
-                            'sub_008_day_21_data.csv',  # extra at home day
-                            'sub_008_day_22_data.csv',  # exclude DT
-                            'sub_008_day_23_data.csv',  # exclude BS
-                            'sub_008_day_24_data.csv',  # exclue BS
-                            'sub_015_day_22_data.csv',  # exclude DT
-                            'sub_015_day_23_data.csv',  # exclude BS
-                            'sub_015_day_24_data.csv',  # exclude BS
-                            'sub_019_day_13_data.csv',  # computer froze
-                            'sub_019_day_18_data.csv',  # exclude DT
-                            'sub_019_day_22_data.csv',  # exclude BS
-                            'sub_019_day_23_data.csv',  # exclude BS
-                            'sub_019_day_24_data.csv'
-                    ]:  # extra at home day
-
-                        df = pd.read_csv(f_full_path)
-                        df['f_name'] = fs
-
-                        # sub_003 somehow replicated day 18
-                        # fix that here
-                        if fs == 'sub_003_day_19_data.csv':
-                            df['day'] = 19
-                        elif fs == 'sub_003_day_20_data.csv':
-                            df['day'] = 20
-
-                        # NOTE: sub_006 mislabeled days 22, 23, and 24 as sub_001
-                        # manually change file name to: sub_006_day_22_data.csv,
-                        # sub_006_day_23_data.csv, sub_006_day_24_data.csv
-                        # fix that here
-                        if fs == 'sub_006_day_22_data.csv':
-                            df['subject'] = 6
-                        elif fs == 'sub_006_day_23_data.csv':
-                            df['subject'] = 6
-                        elif fs == 'sub_006_day_24_data.csv':
-                            df['subject'] = 6
-
-                        # fix sub_015 mislabeling in raw data
-                        # also fix extra 1 in day 7 (trial 60 or 61) manually
-                        if fs == 'sub_015_day_01_data.csv':
-                            df['subject'] = 15
-
-                        # sub_016 mislabeled day 22 as sub_001 and had already
-                        # changed file name to: sub_016_day_22_data.csv
-                        # changing from subject 1 to subject 16
-                        # fix that here
-                        if fs == 'sub_016_day_22_data.csv':
-                            df['subject'] = 16
-
-                        # NOTE: sub_017 day 17 mislabeled to sub_007_day_17_data.csv
-                        # manually change file name to: sub_017_day_17_data.csv
-                        # fix subject column here
-                        if fs == 'sub_017_day_17_data.csv':
-                            df['subject'] = 17
-
-                        # NOTE: sub_019
-                        # mislabeled day 1 as sub_001
-                        # no need to manually change file name
-                        # fix that here
-                        if fs == 'sub_019_day_01_data.csv':
-                            df['subject'] = 19
-
-                        # from trial 276 on day 24, 'day' changes to day 25
-                        # (until the end of the expt)
-                        # also, in this file there are 4 lines of ,,,,,,,,,,,
-                        # after the end of the experiment
-                        # manually removed those lines
-                        # fix that here
-                        if fs == 'sub_019_day_24_data.csv':
-                            df['day'] = 24
-
-                        day = df['day'].unique()
-
-                        # training days
-                        if ~np.isin(day, [22, 23, 24]):
-                            df_train_rec.append(df)
-
-                        # dual-task days
-                        if day == 22:
-                            df_dt_rec.append(df)
-
-                        # button-switch days
-                        if day in [23, 24]:
-                            df_bs_rec.append(df)
+                if os.path.isfile(f_full_path) and fs not in EXCLUDE_FILES:
+                    yield f_full_path
+
+
+def iter_lab_csvs(dir_data_lab_beh):
+    """
+    Yield the path of every lab behavioral CSV in dir_data_lab_beh.
+    """
 
     for fd in os.listdir(dir_data_lab_beh):
         f_df = os.path.join(dir_data_lab_beh, fd)
         if os.path.isfile(f_df) and fd != '.DS_Store':
-            df = pd.read_csv(f_df)
+            yield f_df
+
+
+def iter_tables(paths):
+    """
+    Lazily read each CSV in paths with pyarrow's multithreaded parser,
+    keeping only READ_COLUMNS and tagging every row with its source file
+    name (f_name).
+    """
+
+    convert_options = pa_csv.ConvertOptions(include_columns=READ_COLUMNS,
+                                            include_missing_columns=True)
+
+    for p in paths:
+        tbl = pa_csv.read_csv(p, convert_options=convert_options)
+        # NOTE: columns a file doesn't have come back as all-null; drop them
+        #       so that concat_tables fills them in like any missing column
+        tbl = tbl.select(
+            [f.name for f in tbl.schema if not pa.types.is_null(f.type)])
+        yield tbl.append_column('f_name',
+                                pa.array([os.path.basename(p)] * tbl.num_rows))
+
+
+def read_csvs(paths):
+    """
+    Read a list of trial-level CSVs and return them as a single dataframe.
+    Columns missing from some files are filled with NaN, as pd.concat would.
+    The tables are concatenated without copying and the arrow buffers are
+    released as the dataframe is built, so only one copy of the data is
+    held in memory at a time.
+    """
+
+    tbl = pa.concat_tables(iter_tables(paths), promote_options='default')
+
+    return tbl.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def trial_in_subject(subject):
+    """
+    Running trial count within each subject for a frame that is already
+    sorted by subject (same result as groupby('subject').cumcount()).
+    """
+
+    subject = np.asarray(subject)
+    starts = np.searchsorted(subject, np.unique(subject))
+    offsets = np.repeat(starts, np.diff(np.append(starts, len(subject))))
 
-            # mislabelled sub_003_day_401_data.csv
-            # manually changed file name to: sub_003_day_403_data.csv
-            # fix here
-            if fd == 'sub_003_day_401_data.csv':
-                df['day'] = 403
+    return np.arange(len(subject)) - offsets
 
-            # mislabelled sub_015_day_15_data.csv
-            # manually changed file name to: sub_015_day_215_data.csv
-            # fix here
-            if fd == 'sub_015_day_15_data.csv':
-                df['day'] = 215
 
-            df_lab_rec.append(df)
+def cache_valid(f_cache, f_src, f_inputs, inputs):
+    """
+    True if every cache file in f_cache exists, is newer than all of the
+    source files in f_src, and was built from the same input files (the
+    names listed in f_inputs match inputs).
+    """
+
+    if not all(os.path.exists(f) for f in f_cache + [f_inputs]):
+        return False
+
+    with open(f_inputs) as f:
+        if f.read().splitlines() != inputs:
+            return False
+
+    t_src = max(os.path.getmtime(f) for f in f_src)
+    t_cache = min(os.path.getmtime(f) for f in f_cache)
+
+    return t_src < t_cache
+
+
+if __name__ == '__main__':
+
+    # NOTE: Init figure style
+    sns.set_palette("rocket", n_colors=4)
+    plt.rc('axes', labelsize=14)
+    plt.rc('xtick', labelsize=12)
+    plt.rc('ytick', labelsize=12)
+
+    dir_data = "../data"
+    dir_data_lab_beh = "../data_lab_behave"
+
+    f_home = list(iter_home_csvs(dir_data))
+    f_lab = list(iter_lab_csvs(dir_data_lab_beh))
 
     block_size = 25
 
-    d = pd.concat(df_train_rec, ignore_index=True)
-    d.sort_values(by=['subject', 'day', 'trial'], inplace=True)
-    d['acc'] = (d['cat'] == d['resp']).astype(int)
-    d['day'] = d.groupby('subject')['day'].rank(method='dense').astype(int)
-    d['trial'] = d.groupby(['subject']).cumcount()
-    d['n_trials'] = d.groupby(['subject', 'day'])['trial'].transform('count')
-    d['block'] = d.groupby(['subject', 'day'
-                            ])['trial'].transform(lambda x: x // block_size)
-    d['session_type'] = 'Training at home'
-
-    d_dt = pd.concat(df_dt_rec, ignore_index=True)
-    d_dt.sort_values(by=['subject', 'day', 'trial'], inplace=True)
-    d_dt['acc'] = (d_dt['cat'] == d_dt['resp']).astype(int)
-    d_dt['day'] = d_dt.groupby('subject')['day'].rank(
-        method='dense').astype(int)
-    d_dt['day'] = d_dt['day'].map({1: 22})
-    d_dt['trial'] = d_dt.groupby(['subject']).cumcount()
-    d_dt['n_trials'] = d_dt.groupby(['subject',
-                                     'day'])['trial'].transform('count')
-    d_dt['session_type'] = 'Dual-Task at home'
-
-    d_bs = pd.concat(df_bs_rec, ignore_index=True)
-    d_bs.sort_values(by=['subject', 'day', 'trial'], inplace=True)
-    d_bs['acc'] = (d_bs['cat'] == d_bs['resp']).astype(int)
-    d_bs['day'] = d_bs.groupby('subject')['day'].rank(
-        method='dense').astype(int)
-    d_bs['day'] = d_bs['day'].map({1: 23, 2: 24})
-    d_bs['trial'] = d_bs.groupby(['subject']).cumcount()
-    d_bs['n_trials'] = d_bs.groupby(['subject',
-                                     'day'])['trial'].transform('count')
-    d_bs['session_type'] = 'Button-Switch at home'
-
-    d_lab = pd.concat(df_lab_rec, ignore_index=True)
-    d_lab['acc'] = (d_lab['cat'] == d_lab['resp']).astype(int)
-    d_lab['day'] = d_lab.groupby('subject')['day'].rank(
-        method='dense').astype(int)
-    d_lab['day'] = d_lab['day'].map({1: 0.5, 2: 4.5, 3: 8.5, 4: 12.5, 5: 21})
-    d_lab['trial'] = d_lab.groupby(['subject']).cumcount()
-    d_lab['n_trials'] = d_lab.groupby(['subject',
-                                       'day'])['trial'].transform('count')
-    d_lab['block'] = d_lab.groupby(
-        ['subject', 'day'])['trial'].transform(lambda x: x // block_size)
-    d_lab['session_type'] = 'Training in the Lab'
-
-    # NOTE: create a numpy array of the intersection of subjects across all dataframes
-    all_subs = np.unique(
-        np.concatenate([
-            d.subject.unique(),
-            d_dt.subject.unique(),
-            d_bs.subject.unique(),
-            d_lab.subject.unique()
-        ]))
-
-    subs_to_keep = np.intersect1d(all_subs, d.subject.unique())
-    subs_to_keep = np.intersect1d(subs_to_keep, d_dt.subject.unique())
-    subs_to_keep = np.intersect1d(subs_to_keep, d_bs.subject.unique())
-    subs_to_keep = np.intersect1d(subs_to_keep, d_lab.subject.unique())
-
-    # merge all dataframes inserting np.nan into columns that don't exist in a particular dataframe
-    d_all = pd.concat([d, d_dt, d_bs, d_lab], ignore_index=True, sort=False)
-    d_all['day'] = d_all.groupby('subject')['day'].rank(
-        method='dense').astype(int)
-
-    # exclude subjects not in all three dataframes
-    d_all = d_all[d_all['subject'].isin(subs_to_keep)].reset_index(drop=True)
-
-    # NOTE: compute Stroop accuracy and exlcude subjects with accuracy < 80%
-    d_all['acc_stroop'] = np.nan
-    d_all.loc[d_all['ns_correct_side'].notna(), 'acc_stroop'] = (
-        d_all['ns_correct_side'] == d_all['ns_resp']).astype(int)
-    d_all['acc_stroop_mean'] = d_all.groupby(
-        'subject')['acc_stroop'].transform(lambda x: np.nanmean(x))
-    d_all = d_all[d_all['acc_stroop_mean'] >= 0.8].reset_index(drop=True)
+    # NOTE: the cleaned dataframes are cached as parquet and reused as long
+    #       as they are newer than every data file and than this script
+    #       (so editing the exclusions / fixes above forces a rebuild). The
+    #       names of the data files they were built from are kept alongside,
+    #       so adding or removing a data file also forces a rebuild.
+    dir_cache = "../cache"
+    f_cache_d = os.path.join(dir_cache, "d.parquet")
+    f_cache_d_all = os.path.join(dir_cache, "d_all.parquet")
+    f_cache_inputs = os.path.join(dir_cache, "inputs.txt")
+    cache_inputs = sorted(os.path.basename(f) for f in f_home + f_lab)
+
+    if cache_valid([f_cache_d, f_cache_d_all], f_home + f_lab + [__file__],
+                   f_cache_inputs, cache_inputs):
+        d = pd.read_parquet(f_cache_d)
+        d_all = pd.read_parquet(f_cache_d_all)
+
+    else:
+        d_home = read_csvs(f_home)
+        d_lab = read_csvs(f_lab)
+
+        # NOTE: apply the per-file subject / day fixes (see FIX_* above)
+        d_home['subject'] = d_home['f_name'].map(FIX_SUBJECT).fillna(
+            d_home['subject']).astype(int)
+        d_home['day'] = d_home['f_name'].map(FIX_DAY).fillna(
+            d_home['day']).astype(int)
+        d_lab['day'] = d_lab['f_name'].map(FIX_DAY_LAB).fillna(
+            d_lab['day']).astype(int)
+
+        # NOTE: split at-home files by session type in a single pass using
+        #       a day lookup (any other day is a training day). Each file
+        #       holds a single day once the fixes above are applied. Columns
+        #       that only exist in the other session types are dropped.
+        home_session = d_home['day'].map({
+            22: 'Dual-Task at home',
+            23: 'Button-Switch at home',
+            24: 'Button-Switch at home'
+        }).fillna('Training at home')
+        d_home_split = {
+            st: x.dropna(axis=1, how='all').reset_index(drop=True)
+            for st, x in d_home.groupby(home_session, sort=False)
+        }
+
+        d = d_home_split['Training at home']
+        d.sort_values(by=['subject', 'day', 'trial'], inplace=True)
+        d['acc'] = (d['cat'] == d['resp']).astype(int)
+        d['trial'] = trial_in_subject(d['subject'])
+        d['n_trials'] = d.groupby(['subject',
+                                   'day'])['trial'].transform('count')
+        d['block'] = d['trial'] // block_size
+        d['session_type'] = 'Training at home'
+
+        d_dt = d_home_split['Dual-Task at home']
+        d_dt.sort_values(by=['subject', 'day', 'trial'], inplace=True)
+        d_dt['acc'] = (d_dt['cat'] == d_dt['resp']).astype(int)
+        d_dt['trial'] = trial_in_subject(d_dt['subject'])
+        d_dt['n_trials'] = d_dt.groupby(['subject',
+                                         'day'])['trial'].transform('count')
+        d_dt['session_type'] = 'Dual-Task at home'
+
+        d_bs = d_home_split['Button-Switch at home']
+        d_bs.sort_values(by=['subject', 'day', 'trial'], inplace=True)
+        d_bs['acc'] = (d_bs['cat'] == d_bs['resp']).astype(int)
+        d_bs['trial'] = trial_in_subject(d_bs['subject'])
+        d_bs['n_trials'] = d_bs.groupby(['subject',
+                                         'day'])['trial'].transform('count')
+        d_bs['session_type'] = 'Button-Switch at home'
+
+        d_lab['acc'] = (d_lab['cat'] == d_lab['resp']).astype(int)
+        d_lab['trial'] = d_lab.groupby(['subject']).cumcount()
+        d_lab['n_trials'] = d_lab.groupby(['subject',
+                                           'day'])['trial'].transform('count')
+        d_lab['block'] = d_lab['trial'] // block_size
+        d_lab['session_type'] = 'Training in the Lab'
+
+        # NOTE: create a numpy array of the intersection of subjects across all dataframes
+        all_subs = np.unique(
+            np.concatenate([
+                d.subject.unique(),
+                d_dt.subject.unique(),
+                d_bs.subject.unique(),
+                d_lab.subject.unique()
+            ]))
+
+        subs_to_keep = np.intersect1d(all_subs, d.subject.unique())
+        subs_to_keep = np.intersect1d(subs_to_keep, d_dt.subject.unique())
+        subs_to_keep = np.intersect1d(subs_to_keep, d_bs.subject.unique())
+        subs_to_keep = np.intersect1d(subs_to_keep, d_lab.subject.unique())
+
+        # merge all dataframes inserting np.nan into columns that don't exist in a particular dataframe
+        # NOTE: the per-trial counters are downcast before the merge
+        int_cols = {'acc': 'int8', 'trial': 'int32', 'n_trials': 'int32'}
+        d_all = pd.concat([f.astype(int_cols) for f in [d, d_dt, d_bs, d_lab]],
+                          ignore_index=True,
+                          sort=False)
+
+        # NOTE: use categoricals for the heavily grouped key columns. The
+        #       session type categories are in the order that they first
+        #       appear on the day axis, which sets the legend order below.
+        session_types = [
+            'Training in the Lab',
+            'Training at home',
+            'Dual-Task at home',
+            'Button-Switch at home',
+        ]
+        d_all['subject'] = d_all['subject'].astype('category')
+        d_all['session_type'] = pd.Categorical(d_all['session_type'],
+                                               categories=session_types)
+        d_all['f_name'] = d_all['f_name'].astype('category')
+
+        # NOTE: rank days within each subject x session type in one pass,
+        #       then place the special sessions on the common day axis
+        d_all['day'] = d_all.groupby(['subject', 'session_type'],
+                                     observed=True,
+                                     sort=False)['day'].rank(method='dense')
+        day_map = {
+            'Dual-Task at home': {
+                1: 22
+            },
+            'Button-Switch at home': {
+                1: 23,
+                2: 24
+            },
+            'Training in the Lab': {
+                1: 0.5,
+                2: 4.5,
+                3: 8.5,
+                4: 12.5,
+                5: 21
+            },
+        }
+        for st, st_map in day_map.items():
+            is_st = d_all['session_type'] == st
+            d_all.loc[is_st, 'day'] = d_all.loc[is_st, 'day'].map(st_map)
+
+        # training days (ranked within subject) are what the DBM fits use
+        d = d_all.loc[d_all['session_type'] == 'Training at home',
+                      d.columns].astype(d.dtypes).reset_index(drop=True)
+
+        d_all['day'] = d_all.groupby(
+            'subject', observed=True,
+            sort=False)['day'].rank(method='dense').astype(int)
+
+        # exclude subjects not in all three dataframes
+        d_all = d_all[d_all['subject'].isin(subs_to_keep)].reset_index(
+            drop=True)
+
+        # NOTE: compute Stroop accuracy and exlcude subjects with accuracy < 80%
+        d_all['acc_stroop'] = np.nan
+        d_all.loc[d_all['ns_correct_side'].notna(), 'acc_stroop'] = (
+            d_all['ns_correct_side'] == d_all['ns_resp']).astype(int)
+        d_all['acc_stroop_mean'] = d_all.groupby(
+            'subject', observed=True,
+            sort=False)['acc_stroop'].transform('mean')
+        d_all = d_all[d_all['acc_stroop_mean'] >= 0.8].reset_index(drop=True)
+
+        os.makedirs(dir_cache, exist_ok=True)
+        d.to_parquet(f_cache_d, compression="zstd")
+        d_all.to_parquet(f_cache_d_all, compression="zstd")
+        with open(f_cache_inputs, 'w') as f:
+            f.write('\n'.join(cache_inputs) + '\n')
 
     # NOTE: primary exclusion criteria for remaining subjects will be deciion bound fits
     #       Fit DBM here
-    models = [
-        nll_unix,
-        nll_unix,
-        nll_uniy,
-        nll_uniy,
-        nll_glc,
-        nll_glc,
-    ]
-    side = [0, 1, 0, 1, 0, 1, 0, 1, 2, 3]
-    k = [2, 2, 2, 2, 3, 3, 3, 3, 3, 3]
     n = block_size
-    model_names = [
-        "nll_unix_0",
-        "nll_unix_1",
-        "nll_uniy_0",
-        "nll_uniy_1",
-        "nll_glc_0",
-        "nll_glc_1",
-    ]
 
     if not os.path.exists("../dbm_fits/dbm_results.csv"):
-        dbm = (d.groupby(["subject", "day"]).apply(fit_dbm, models, side, k, n,
-                                                   model_names).reset_index())
+        # NOTE: each subject x day fit is independent, so farm them out
+        #       across cores rather than using a serial groupby-apply
+        dbm_groups = list(d.groupby(["subject", "day"]))
+        dbm_rec = Parallel(n_jobs=-1, backend="loky")(delayed(fit_dbm)(dd, n)
+                                                      for _, dd in dbm_groups)
+        dbm = pd.concat(dbm_rec,
+                        keys=[key for key, _ in dbm_groups],
+                        names=["subject", "day"]).reset_index()
         dbm.to_csv("../dbm_fits/dbm_results.csv")
     else:
         dbm = pd.read_csv("../dbm_fits/dbm_results.csv")
         dbm = dbm[["subject", "day", "model", "bic", "p"]]
 
-    def assign_best_model(x):
-        model = x["model"].to_numpy()
-        bic = x["bic"].to_numpy()
-        best_model = np.unique(model[bic == bic.min()])[0]
-        x["best_model"] = best_model
-        return x
-
-    dbm = dbm.groupby(["subject",
-                       "day"]).apply(assign_best_model,
-                                     include_groups=False).reset_index()
-    dbm = dbm[dbm["model"] == dbm["best_model"]]
-    dbm = dbm[["subject", "day", "bic", "best_model"]]
-    dbm = dbm.drop_duplicates().reset_index(drop=True)
-    dbm["best_model_class"] = dbm["best_model"].str.split("_").str[1]
-    dbm.loc[dbm["best_model_class"] != "glc",
-            "best_model_class"] = "rule-based"
-    dbm.loc[dbm["best_model_class"] == "glc",
-            "best_model_class"] = "procedural"
+    # NOTE: keep the best fitting (min BIC) model per subject x day
+    dbm = dbm.loc[dbm.groupby(["subject", "day"])["bic"].idxmin(),
+                  ["subject", "day", "bic", "model"]]
+    dbm = dbm.rename(columns={"model": "best_model"}).reset_index(drop=True)
+    dbm["best_model"] = dbm["best_model"].astype("category")
+    dbm["best_model_class"] = np.where(dbm["best_model"].str.contains("_glc_"),
+                                       "procedural", "rule-based")
     dbm["best_model_class"] = dbm["best_model_class"].astype("category")
-    dbm = dbm.reset_index(drop=True)
 
     # print proportion of best model classes across all subjects and days
     dbm.groupby('day')['best_model_class'].value_counts(normalize=True)
@@ -340,10 +459,8 @@ if __name__ == '__main__':
 
     # NOTE: aggregate data for upcoming figures
     d_all = d_all[d_all['rt'] <= 3000]
-    dd_all = d_all.groupby(['subject', 'day', 'session_type']).agg({
-        'acc': 'mean',
-        'rt': 'mean'
-    }).reset_index()
+    dd_all = d_all.groupby(['subject', 'day', 'session_type'],
+                           observed=True)[['acc', 'rt']].mean().reset_index()
 
     # NOTE: Figure --- all session types
     fig, ax = plt.subplots(1, 1, squeeze=False, figsize=(8, 5))
@@ -381,9 +498,14 @@ if __name__ == '__main__':
     plt.savefig('../figures/training_performance_days_rt.png', dpi=300)
     plt.close()
 
+    # NOTE: index the aggregate by day once for the comparison figures below
+    #       (a stable sort keeps subjects in the same order within each day,
+    #       which the paired tests rely on)
+    dd_day = dd_all.set_index('day', drop=False).sort_index(kind='stable')
+
     # NOTE: dual-task figures
     # prepare a data frame comparing last day of training to dual-task day
-    d_dtf = dd_all[dd_all['day'].isin([20, 22])].copy()
+    d_dtf = dd_day.loc[[20, 22]].reset_index(drop=True)
 
     # change the day column to categorical for plotting with names "Last Training Day" and "Dual-Task Day"
     d_dtf['day'] = d_dtf['day'].map({
@@ -406,15 +528,14 @@ if __name__ == '__main__':
     plt.close()
 
     # NOTE: dual-task stats
-    res = pg.ttest(x=d_dtf[d_dtf['day'] == 'Last Training Day']['acc'],
-                   y=d_dtf[d_dtf['day'] == 'Dual-Task Day']['acc'],
-                   alternative='greater',
-                   paired=True)
+    acc_last = d_dtf.loc[d_dtf['day'] == 'Last Training Day', 'acc'].to_numpy()
+    acc_dt = d_dtf.loc[d_dtf['day'] == 'Dual-Task Day', 'acc'].to_numpy()
+    res = ttest_rel(acc_last, acc_dt, alternative='greater')
 
     # NOTE: button-switch figures
 
     # prepare a data frame comparing last day of training to button-switch days
-    d_bsf = dd_all[dd_all['day'].isin([20, 23, 24])].copy()
+    d_bsf = dd_day.loc[[20, 23, 24]].reset_index(drop=True)
 
     # change the day column to categorical for plotting with names "Last Training Day", "Button-Switch Day 1", "Button-Switch Day 2"
     d_bsf['day'] = d_bsf['day'].map({
@@ -436,26 +557,26 @@ if __name__ == '__main__':
     plt.close()
 
     # NOTE: button-switch stats
-    res_bs1 = pg.ttest(x=d_bsf[d_bsf['day'] == 'Last Training Day']['acc'],
-                       y=d_bsf[d_bsf['day'] == 'Button-Switch Day 1']['acc'],
-                       alternative='greater',
-                       paired=True)
-
-    res_bs2 = pg.ttest(x=d_bsf[d_bsf['day'] == 'Last Training Day']['acc'],
-                       y=d_bsf[d_bsf['day'] == 'Button-Switch Day 2']['acc'],
-                       alternative='greater',
-                       paired=True)
+    acc_last = d_bsf.loc[d_bsf['day'] == 'Last Training Day', 'acc'].to_numpy()
+    acc_bs1 = d_bsf.loc[d_bsf['day'] == 'Button-Switch Day 1',
+                        'acc'].to_numpy()
+    acc_bs2 = d_bsf.loc[d_bsf['day'] == 'Button-Switch Day 2',
+                        'acc'].to_numpy()
+    res_bs1 = ttest_rel(acc_last, acc_bs1, alternative='greater')
+    res_bs2 = ttest_rel(acc_last, acc_bs2, alternative='greater')
 
     # NOTE: Make EEG predictions figure
     # draw 5 sets of two gaussians one centered at 500 ms and another centered at 1000 ms
     # let the amplitude of these gaussian increase across the 5 sets, but at different rates for
-    # each centre. 
+    # each centre.
     fig, ax = plt.subplots(1, 1, squeeze=False, figsize=(8, 5))
+    # NOTE: the gaussians are computed once and scaled per set by broadcasting
     x = np.linspace(0, 1500, 1000)
-    for i in range(5):
-        y1 = (2*i + 1) * np.exp(-0.5 * ((x - 500) / 100)**2)
-        y2 = (i + 2) * np.exp(-0.5 * ((x - 1000) / 100)**2)
-        ax[0, 0].plot(x, y1 + y2, label=f'Set {i+1}')
+    g1 = np.exp(-0.5 * ((x - 500) / 100)**2)
+    g2 = np.exp(-0.5 * ((x - 1000) / 100)**2)
+    sets = np.arange(5)[:, None]
+    curves = (2 * sets + 1) * g1 + (sets + 2) * g2
+    ax[0, 0].plot(x, curves.T, label=[f'Set {i+1}' for i in range(5)])
     ax[0, 0].set_xlabel('Time within trial (ms)', fontsize=16)
     ax[0, 0].set_ylabel('Functional Connectivity (a.u.)', fontsize=16)
     ax[0, 0].legend().remove()
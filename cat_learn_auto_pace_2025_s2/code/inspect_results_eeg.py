@@ -19,7 +19,17 @@ dir_data_eeg = '../data_lab_eeg'
 # P3_D5.bdf
 
 f = os.path.join(dir_data_eeg, 'P2_D1.bdf')
-raw = mne.io.read_raw_bdf(f, preload=True)
+
+# NOTE: parsing the bdf is slow, so the raw data are cached as fif after the
+#       first read and the cache is rebuilt whenever the bdf is newer
+dir_cache = '../cache'
+f_cache = os.path.join(dir_cache, 'P2_D1_raw.fif')
+if os.path.exists(f_cache) and os.path.getmtime(f_cache) >= os.path.getmtime(f):
+    raw = mne.io.read_raw_fif(f_cache, preload=True)
+else:
+    raw = mne.io.read_raw_bdf(f, preload=True)
+    os.makedirs(dir_cache, exist_ok=True)
+    raw.save(f_cache, overwrite=True)
 
 # triggers
 events = mne.find_events(raw, stim_channel='Status', shortest_event=1)
@@ -37,7 +47,13 @@ events = mne.find_events(raw, stim_channel='Status', shortest_event=1)
 # }
 
 # get epochs for STIM_ONSET_A
-epochs = mne.Epochs(raw, events, event_id=20, tmin=-0.2, tmax=0.8, baseline=(None, 0), preload=True)
+# NOTE: only the alpha band is analysed, so epochs are decimated to ~256 Hz.
+#       The raw data are low-passed at 40 Hz first so nothing above the new
+#       128 Hz Nyquist (e.g. EMG) aliases into the alpha band.
+raw.filter(None, 40.)
+decim = max(1, int(raw.info['sfreq'] // 256))
+epochs = mne.Epochs(raw, events, event_id=20, tmin=-0.2, tmax=0.8, baseline=(None, 0), preload=True,
+                    decim=decim)
 
 # plot functional connectivity using coherence
 from mne.viz import circular_layout
@@ -46,14 +62,14 @@ from mne_connectivity.viz import plot_connectivity_circle
 
 # Define parameters for connectivity analysis
 fmin, fmax = 8., 12.  # Alpha band
-sfreq = raw.info['sfreq']
+sfreq = epochs.info['sfreq']
 con_methods = ['coh']
 
 # Compute connectivity
 con, freqs, times, n_epochs, n_tapers = spectral_connectivity_epochs(
     epochs, method=con_methods, mode='fourier', sfreq=sfreq,
     fmin=fmin, fmax=fmax, faverage=True, tmin=0.0, tmax=0.8,
-    mt_adaptive=False, n_jobs=1)
+    mt_adaptive=False, n_jobs=-1)
 
 # Prepare labels and colors for circular plot
 labels = epochs.ch_names
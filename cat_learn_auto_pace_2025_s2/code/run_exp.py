@@ -4,7 +4,7 @@ Single-phase categorization task (PsychoPy-only) with veridical feedback and EEG
 Maintains the original state-machine style and adds 'day' (repeated-measures).
 """
 
-import os, sys
+import os, sys, csv, time
 import numpy as np
 import pandas as pd
 from psychopy import visual, core, event, logging # type: ignore
@@ -12,7 +12,7 @@ from psychopy.hardware import keyboard # type: ignore
 from util_func import *
 
 # --------------------------- EEG (Parallel Port) helper ---------------------------
-# Flip-locked rising edges; non-blocking clear to zero a few ms later.
+# Flip-locked rising edges; flip-locked clear to zero a whole number of frames later.
 EEG_ENABLED = False
 EEG_PORT_ADDRESS = '0x3FD8'
 EEG_DEFAULT_PULSE_MS = 10
@@ -29,6 +29,22 @@ TRIG = {
     "EXP_END": 15,
 }
 
+# response key -> (category label, response trigger)
+RESP_INFO = {
+    'd': ("A", TRIG["RESP_A"]),
+    'k': ("B", TRIG["RESP_B"]),
+}
+
+# feedback -> (ring colour, feedback trigger)
+FB_INFO = {
+    "Correct": ('green', TRIG["FB_COR"]),
+    "Incorrect": ('red', TRIG["FB_INC"]),
+}
+
+# key lists polled in the main loop (built once rather than every frame)
+START_KEYS = ('space', )
+RESP_KEYS = ('d', 'k')
+
 
 class EEGPort:
 
@@ -36,53 +52,53 @@ class EEGPort:
                  win,
                  address=EEG_PORT_ADDRESS,
                  enabled=EEG_ENABLED,
-                 default_ms=EEG_DEFAULT_PULSE_MS):
+                 default_ms=EEG_DEFAULT_PULSE_MS,
+                 flip_rate=60.0):
         self.win = win
         self.enabled = enabled
         self.default_ms = default_ms
+        self.flip_rate = flip_rate
         self._port = None
-        self._clear_at = None
+        # frames (i.e., update calls) left until the port is cleared
+        self._clear_frames = 0
+        if self.enabled:
+            try:
+                from psychopy import parallel # type: ignore
+                self._port = parallel.ParallelPort(address=address)
+            except Exception as e:
+                print(
+                    f"[EEG] Parallel port unavailable ({e}). Running without triggers."
+                )
+                self.enabled = False
+                self._port = None
         if not self.enabled:
-            return
-        try:
-            from psychopy import parallel # type: ignore
-            self._port = parallel.ParallelPort(address=address)
-        except Exception as e:
-            print(
-                f"[EEG] Parallel port unavailable ({e}). Running without triggers."
-            )
-            self.enabled = False
-            self._port = None
-
-    def flip_pulse(self, code, width_ms=None, global_clock=None):
-        """Schedule a flip-locked pulse: set code on next win.flip, clear after width_ms."""
-        if not (self.enabled and self._port):
-            return
+            # NOTE: shadow the per-frame / per-event methods with no-ops so
+            #       the methods below never need to check for a port
+            self.flip_pulse = self.pulse_now = lambda *a, **k: None
+            self.update = lambda: None
+
+    def _width_frames(self, width_ms):
         width_ms = self.default_ms if width_ms is None else width_ms
+        return max(1, int(round(width_ms * self.flip_rate / 1000.0)))
+
+    def flip_pulse(self, code, width_ms=None):
+        """Schedule a flip-locked pulse: set code on next win.flip, clear on the flip width_ms (in frames) later."""
         # rising edge exactly on next flip:
         self.win.callOnFlip(self._port.setData, int(code) & 0xFF)
-        # schedule a timed clear to 0 after the flip:
-        if global_clock is not None:
-            # record when to clear (relative to global clock)
-            self._clear_at = global_clock.getTime() + (width_ms / 1000.0)
+        self._clear_frames = self._width_frames(width_ms)
 
-    def pulse_now(self, code, width_ms=None, global_clock=None):
+    def pulse_now(self, code, width_ms=None):
         """Immediate pulse (not flip-locked) -- useful for response events."""
-        if not (self.enabled and self._port):
-            return
-        width_ms = self.default_ms if width_ms is None else width_ms
         self._port.setData(int(code) & 0xFF)
-        if global_clock is not None:
-            self._clear_at = global_clock.getTime() + (width_ms / 1000.0)
-
-    def update(self, global_clock=None):
-        """Call every frame: clears the port to 0 if a pulse has expired."""
-        if not (self.enabled and self._port):
-            return
-        if self._clear_at is not None and global_clock is not None:
-            if global_clock.getTime() >= self._clear_at:
-                self._port.setData(0)
-                self._clear_at = None
+        self._clear_frames = self._width_frames(width_ms)
+
+    def update(self):
+        """Call once per frame: clears the port to 0 on the flip that ends a pulse."""
+        if self._clear_frames:
+            self._clear_frames -= 1
+            if not self._clear_frames:
+                # falling edge exactly on next flip:
+                self.win.callOnFlip(self._port.setData, 0)
 
     def close(self):
         try:
@@ -125,6 +141,19 @@ if __name__ == "__main__":
     ds = ds.sample(frac=1).reset_index(drop=True)
     n_trial = ds.shape[0]
 
+    # NOTE: pull the trial columns out as numpy arrays once so the main loop
+    #       indexes plain arrays rather than paying for pandas .iloc per trial
+    cat_arr = ds['cat'].to_numpy()
+    x_arr = ds['x'].to_numpy()
+    y_arr = ds['y'].to_numpy()
+    xt_arr = ds['xt'].to_numpy()
+    yt_arr = ds['yt'].to_numpy()
+
+    # NOTE: pre-sample the 200-400 ms jitters that follow the ITI, the
+    #       response and the feedback on every trial
+    rng = np.random.default_rng(subject * 100 + day)
+    jitters = rng.integers(200, 401, size=(n_trial, 3))
+
     # NOTE: Uncomment to visualize stimulus space scatter
     # import matplotlib.pyplot as plt
     # import seaborn as sns
@@ -141,6 +170,11 @@ if __name__ == "__main__":
     size_cm = 5
     size_px = int(size_cm * px_per_cm)
 
+    # NOTE: convert every trial's stimulus to grating units up front
+    #       (spatial frequency in cycles / pix, orientation in degrees)
+    sf_pix_arr = xt_arr / px_per_cm
+    ori_deg_arr = yt_arr * (180.0 / np.pi)
+
     win = visual.Window(size=(1920, 1080),
                         fullscr=True,
                         units='pix',
@@ -151,7 +185,9 @@ if __name__ == "__main__":
                         waitBlanking=True)
 
     win.mouseVisible = False
-    frame_rate = win.getActualFrameRate()
+    # NOTE: use the refresh period psychopy already holds for the monitor
+    #       rather than a multi-second getActualFrameRate() measurement
+    frame_rate = 1.0 / win.monitorFramePeriod if win.monitorFramePeriod else 60.0
     print(f"[Info] Frame rate: {frame_rate}")
 
     center_x, center_y = 0, 0
@@ -179,6 +215,9 @@ if __name__ == "__main__":
         color='white',
         height=32)
 
+    # NOTE: sf / ori (and the ring colour) change every trial; autoLog off
+    #       keeps those setters from formatting a log entry each time. The
+    #       setters only flag the stim, which is rebuilt once at the next draw
     grating = visual.GratingStim(win,
                                  tex='sin',
                                  mask='circle',
@@ -186,7 +225,9 @@ if __name__ == "__main__":
                                  size=(size_px, size_px),
                                  units='pix',
                                  sf=0.02,
-                                 ori=0.0)
+                                 ori=0.0,
+                                 pos=(center_x, center_y),
+                                 autoLog=False)
 
     fb_ring = visual.Circle(win,
                             radius=(size_px // 2 + 10),
@@ -195,51 +236,88 @@ if __name__ == "__main__":
                             lineColor='white',
                             lineWidth=10,
                             units='pix',
-                            pos=(center_x, center_y))
+                            pos=(center_x, center_y),
+                            autoLog=False)
 
     kb = keyboard.Keyboard()
-    default_kb = keyboard.Keyboard()
 
-    global_clock = core.Clock()
     state_clock = core.Clock()
-    stim_clock = core.Clock()
 
     # --------------------------- EEG init ----------------------------------------
-    eeg = EEGPort(win)
+    eeg = EEGPort(win, flip_rate=frame_rate)
 
     # --------------------------- State machine setup ------------------------------
     time_state = 0.0
     state_current = "state_init"
     state_entry = True
 
+    # NOTE: what each state draws every frame. The state logic below only
+    #       updates state, and the draw + flip for the frame happen once
+    #       after it. state_jitter's entry is filled in on the way into a
+    #       jitter so the previous screen stays up.
+    state_draw = {
+        "state_init": (init_text, ),
+        "state_finished": (finished_text, ),
+        "state_iti": (fix_h, fix_v),
+        "state_stim": (grating, ),
+        "state_feedback": (grating, fb_ring),
+        "state_jitter": (),
+    }
+
+    # text-only screens, which hand a slice back to the OS after each flip
+    state_idle = ("state_init", "state_finished")
+
+    # NOTE: jitters between states run in state_jitter, which waits
+    #       jitter_ms and then moves on to state_next
+    state_next = None
+    jitter_ms = 0
+
     resp = -1
     rt = -1
     trial = -1
 
     # Record keeping
-    trial_data = {
-        'subject': [],
-        'day': [],
-        'trial': [],
-        'cat': [],
-        'x': [],
-        'y': [],
-        'xt': [],
-        'yt': [],
-        'resp': [],
-        'rt': [],
-        'fb': []
-    }
+    # NOTE: each trial is appended to the csv as a single row (flushed right
+    #       away) rather than rewriting the whole file after every trial
+    trial_cols = [
+        'subject', 'day', 'trial', 'cat', 'x', 'y', 'xt', 'yt', 'resp', 'rt',
+        'fb'
+    ]
+    csv_f = open(full_path, 'w', newline='', buffering=1)
+    csv_w = csv.writer(csv_f)
+    csv_w.writerow(trial_cols)
+    header_size = csv_f.tell()
+
+    # NOTE: everything but the response is known before the session starts,
+    #       so each trial's record is prebuilt and only resp / rt / fb are
+    #       added as trials complete
+    trial_stim = [(subject, day, t, c, x, y, xt, yt)
+                  for t, (c, x, y, xt, yt) in enumerate(
+                      zip(cat_arr, x_arr, y_arr, xt_arr, yt_arr))]
+
+    # NOTE: bind the trigger codes used in the loop to plain names once
+    TRIG_EXP_START = TRIG["EXP_START"]
+    TRIG_EXP_END = TRIG["EXP_END"]
+    TRIG_ITI = TRIG["ITI_ONSET"]
+    TRIG_STIM_A = TRIG["STIM_ONSET_A"]
+    TRIG_STIM_B = TRIG["STIM_ONSET_B"]
 
     # --------------------------- Main loop ---------------------------------------
     running = True
+
+    # NOTE: escape is a psychopy global key, checked by the window during
+    #       win.flip(), so the loop itself doesn't poll for it
+    def stop_running():
+        global running
+        running = False
+
+    event.globalKeys.add(key='escape', func=stop_running)
+
     while running:
 
-        if default_kb.getKeys(keyList=['escape'], waitRelease=False):
-            running = False
-            break
+        eeg.update()
 
-        eeg.update(global_clock)
+        state_drawn = state_current
 
         # --------------------- STATE: INIT ---------------------
         if state_current == "state_init":
@@ -248,40 +326,28 @@ if __name__ == "__main__":
                 win.color = (0.494, 0.494, 0.494)
                 state_entry = False
 
-            time_state = state_clock.getTime() * 1000.0
-            init_text.draw()
-
-            keys = kb.getKeys(keyList=['space'], waitRelease=False, clear=True)
+            keys = kb.getKeys(keyList=START_KEYS, waitRelease=False, clear=True)
             if keys:
-                eeg.flip_pulse(TRIG["EXP_START"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG_EXP_START)
                 state_current = "state_iti"
                 state_entry = True
 
-            win.flip()
-
         # --------------------- STATE: FINISHED ---------------------
         elif state_current == "state_finished":
             if state_entry:
-                eeg.flip_pulse(TRIG["EXP_END"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG_EXP_END)
                 state_clock.reset()
                 state_entry = False
 
-            time_state = state_clock.getTime() * 1000.0
-            finished_text.draw()
-            win.flip()
-
         # --------------------- STATE: ITI ---------------------
         elif state_current == "state_iti":
             if state_entry:
                 state_clock.reset()
-                eeg.flip_pulse(TRIG["ITI_ONSET"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG_ITI)
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
 
-            fix_h.draw()
-            fix_v.draw()
-
             if time_state > 1000:
                 resp = -1
                 rt = -1
@@ -291,116 +357,107 @@ if __name__ == "__main__":
                     state_current = "state_finished"
                     state_entry = True
                 else:
-                    sf_cycles_per_cm = ds['xt'].iloc[trial]
-                    sf_cycles_per_pix = sf_cycles_per_cm / px_per_cm
-                    ori_deg = ds['yt'].iloc[trial] * 180.0 / np.pi
-                    cat = ds['cat'].iloc[trial]
+                    cat = cat_arr[trial]
 
-                    grating.sf = sf_cycles_per_pix
-                    grating.ori = ori_deg
-                    grating.pos = (center_x, center_y)
+                    grating.sf = sf_pix_arr[trial]
+                    grating.ori = ori_deg_arr[trial]
 
                     kb.clearEvents()
-                    state_current = "state_stim"
+                    state_current = "state_jitter"
+                    state_next = "state_stim"
+                    state_draw["state_jitter"] = state_draw["state_iti"]
+                    jitter_ms = jitters[trial, 0]
                     state_entry = True
 
-                    jitter = np.random.randint(200, 401)
-                    core.wait(jitter / 1000.0)
-
-            win.flip()
-
         # --------------------- STATE: STIM ---------------------
         elif state_current == "state_stim":
             if state_entry:
                 if cat == "A":
-                    trig = TRIG["STIM_ONSET_A"]
+                    trig = TRIG_STIM_A
                 else:
-                    trig = TRIG["STIM_ONSET_B"]
+                    trig = TRIG_STIM_B
 
-                eeg.flip_pulse(trig, global_clock=global_clock)
+                eeg.flip_pulse(trig)
 
                 state_clock.reset()
-                stim_clock.reset()
 
                 win.callOnFlip(kb.clock.reset)
                 state_entry = False
 
-            time_state = state_clock.getTime() * 1000.0
-
-            grating.draw()
-
-            keys = kb.getKeys(keyList=['d', 'k'], waitRelease=False)
+            keys = kb.getKeys(keyList=RESP_KEYS, waitRelease=False)
             if keys:
-                k = keys[-1]
+                # NOTE: single-response trial, so the first press is the
+                #       response and its rt is the rt
+                k = keys[0]
                 rt = k.rt * 1000.0
-                if k.name == 'd':
-                    resp_label = "A"
-                    eeg.pulse_now(TRIG["RESP_A"], global_clock=global_clock)
-                else:
-                    resp_label = "B"
-                    eeg.pulse_now(TRIG["RESP_B"], global_clock=global_clock)
-
-                if cat == resp_label:
-                    fb = "Correct"
-                else:
-                    fb = "Incorrect"
+                resp_label, trig_resp = RESP_INFO[k.name]
+                eeg.pulse_now(trig_resp)
 
+                fb = "Correct" if cat == resp_label else "Incorrect"
                 resp = resp_label
 
                 state_clock.reset()
-                state_current = "state_feedback"
+                state_current = "state_jitter"
+                state_next = "state_feedback"
+                state_draw["state_jitter"] = state_draw["state_stim"]
+                jitter_ms = jitters[trial, 1]
                 state_entry = True
 
-                jitter = np.random.randint(200, 401)
-                core.wait(jitter / 1000.0)
-
-            win.flip()
-
         # --------------------- STATE: FEEDBACK ---------------------
         elif state_current == "state_feedback":
             if state_entry:
-
-                if fb == "Correct":
-                    fb_ring.lineColor = 'green'
-                    eeg.flip_pulse(TRIG["FB_COR"], global_clock=global_clock)
-                else:
-                    fb_ring.lineColor = 'red'
-                    eeg.flip_pulse(TRIG["FB_INC"], global_clock=global_clock)
+                fb_color, trig_fb = FB_INFO[fb]
+                fb_ring.lineColor = fb_color
+                eeg.flip_pulse(trig_fb)
 
                 state_clock.reset()
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
 
-            grating.draw()
-            fb_ring.draw()
-
             if time_state > 1000:
-                trial_data['subject'].append(subject)
-                trial_data['day'].append(day)
-                trial_data['trial'].append(trial)
-                trial_data['cat'].append(ds['cat'].iloc[trial])
-                trial_data['x'].append(ds['x'].iloc[trial])
-                trial_data['y'].append(ds['y'].iloc[trial])
-                trial_data['xt'].append(ds['xt'].iloc[trial])
-                trial_data['yt'].append(ds['yt'].iloc[trial])
-                trial_data['resp'].append(resp)
-                trial_data['rt'].append(rt)
-                trial_data['fb'].append(fb)
-
-                pd.DataFrame(trial_data).to_csv(full_path, index=False)
+                csv_w.writerow(trial_stim[trial] + (resp, rt, fb))
+                csv_f.flush()
 
-                state_current = "state_iti"
+                state_current = "state_jitter"
+                state_next = "state_iti"
+                state_draw["state_jitter"] = state_draw["state_feedback"]
+                jitter_ms = jitters[trial, 2]
                 state_entry = True
                 resp = -1
                 rt = -1
 
-                jitter = np.random.randint(200, 401)
-                core.wait(jitter / 1000.0)
+        # --------------------- STATE: JITTER ---------------------
+        # NOTE: non-blocking 200-400 ms wait that keeps the previous screen
+        #       up while the loop keeps flipping (so EEG pulses are cleared
+        #       and escape is handled)
+        elif state_current == "state_jitter":
+            if state_entry:
+                state_clock.reset()
+                state_entry = False
+
+            time_state = state_clock.getTime() * 1000.0
+
+            if time_state >= jitter_ms:
+                state_current = state_next
+                state_entry = True
+
+        # --------------------- DRAW + FLIP ---------------------
+        for stim in state_draw[state_drawn]:
+            stim.draw()
+
+        win.flip()
 
-            win.flip()
+        if state_drawn in state_idle:
+            # NOTE: text-only screen, so hand a slice back to the OS
+            time.sleep(0.0005)
 
     # --------------------------- Cleanup ------------------------------------------
     eeg.close()
+    csv_f.close()
+    # NOTE: a session quit before the first trial was recorded leaves only
+    #       the header, which would block a rerun of this subject / day
+    if os.path.getsize(full_path) == header_size:
+        os.remove(full_path)
     win.close()
     core.quit()
@@ -1,6 +1,6 @@
 from imports import *
 
-def fit_dbm(d, model_func, side, k, n, model_name):
+def fit_dbm(d, n):
 
     fit_args = {
         "obj_func": None,
@@ -13,7 +13,12 @@ def fit_dbm(d, model_func, side, k, n, model_name):
         "tol": 1e-3,
         "polish": False,
         "updating": "deferred",
-        "workers": -1,
+        # NOTE: evaluate the whole population in one call to the jitted
+        #       batch nll (requires deferred updating)
+        "vectorized": True,
+        # NOTE: subject x day fits are already run in parallel by the
+        #       caller, so keep each optimizer single-process here
+        "workers": 1,
     }
 
     obj_func = fit_args["obj_func"]
@@ -24,57 +29,53 @@ def fit_dbm(d, model_func, side, k, n, model_name):
     polish = fit_args["polish"]
     updating = fit_args["updating"]
     workers = fit_args["workers"]
+    vectorized = fit_args["vectorized"]
     popsize = fit_args["popsize"]
     mutation = fit_args["mutation"]
     recombination = fit_args["recombination"]
 
-    sub = d["subject"]
-    day = d["day"]
+    dd = d[["cat", "x", "y", "resp"]]
 
-    drec = []
-    for m, mod in enumerate(model_func):
-        dd = d[(d["subject"] == sub)
-               & (d["day"] == day)][["cat", "x", "y", "resp"]]
-
-        cat = dd.cat.to_numpy()
-        x = dd.x.to_numpy()
-        y = dd.y.to_numpy()
-
-        # nll funcs expect resp to be [0, 1]
-        # remap "A" and "B" to 0 and 1
-        dd["resp"] = dd["resp"].map({"A": 0, "B": 1})
-
-        resp = dd.resp.to_numpy()
-
-        # rescale x and y to be [0, 100]
-        range_x = np.max(x) - np.min(x)
-        x = ((x - np.min(x)) / range_x) * 100
-        range_y = np.max(y) - np.min(y)
-        y = ((y - np.min(y)) / range_y) * 100
-
-        # compute glc bnds
-        yub = np.max(y) + 0.1 * range_y
-        ylb = np.min(y) - 0.1 * range_y
-        bub = 2 * np.max([yub, -ylb])
-        blb = -bub
-        nlb = 0.001
-        nub = np.max([range_x, range_y]) / 2
-
-        if "unix" in model_name[m]:
+    # nll funcs are jitted and cannot take string arrays
+    cat = dd.cat.map({"A": 0, "B": 1}).to_numpy()
+    x = dd.x.to_numpy()
+    y = dd.y.to_numpy()
+
+    # nll funcs expect resp to be [0, 1]
+    # remap "A" and "B" to 0 and 1
+    resp = dd.resp.map({"A": 0, "B": 1}).to_numpy()
+
+    # rescale x and y to be [0, 100]
+    range_x = np.max(x) - np.min(x)
+    x = ((x - np.min(x)) / range_x) * 100
+    range_y = np.max(y) - np.min(y)
+    y = ((y - np.min(y)) / range_y) * 100
+
+    # compute glc bnds
+    yub = np.max(y) + 0.1 * range_y
+    ylb = np.min(y) - 0.1 * range_y
+    bub = 2 * np.max([yub, -ylb])
+    blb = -bub
+    nlb = 0.001
+    nub = np.max([range_x, range_y]) / 2
+
+    z_limit = 3
+
+    def fit_model(m):
+
+        if "unix" in DBM_MODEL_NAMES[m]:
             bnd = ((0, 100), (nlb, nub))
-        elif "uniy" in model_name[m]:
+        elif "uniy" in DBM_MODEL_NAMES[m]:
             bnd = ((0, 100), (nlb, nub))
-        elif "glc" in model_name[m]:
+        elif "glc" in DBM_MODEL_NAMES[m]:
             bnd = ((-1, 1), (blb, bub), (nlb, nub))
-        elif "gcc" in model_name[m]:
+        elif "gcc" in DBM_MODEL_NAMES[m]:
             bnd = ((0, 100), (0, 100), (nlb, nub))
 
-        z_limit = 3
-
-        args = (z_limit, cat, x, y, resp, side[m])
+        args = (z_limit, cat, x, y, resp, DBM_SIDE[m])
 
-        results = differential_evolution(
-            func=mod,
+        return differential_evolution(
+            func=DBM_MODELS[m],
             bounds=bnd,
             args=args,
             disp=disp,
@@ -86,10 +87,16 @@ def fit_dbm(d, model_func, side, k, n, model_name):
             polish=polish,
             updating=updating,
             workers=workers,
+            vectorized=vectorized,
         )
 
-        tmp = np.concatenate((results["x"], [results["fun"]]))
-        tmp = np.reshape(tmp, (tmp.shape[0], 1))
+    # NOTE: the nll funcs release the GIL, so the models are fit
+    #       concurrently in threads
+    with ThreadPoolExecutor(max_workers=len(DBM_MODELS)) as ex:
+        fits = list(ex.map(fit_model, range(len(DBM_MODELS))))
+
+    drec = []
+    for m, results in enumerate(fits):
 
         # a1*x + a2*y + b = 0
         # y = -(a1*x + b) / a2
@@ -98,7 +105,7 @@ def fit_dbm(d, model_func, side, k, n, model_name):
         b = results['x'][1]
 
         print(d[["subject", "day"]].iloc[0])
-        print(model_name[m], results["x"], results["fun"])
+        print(DBM_MODEL_NAMES[m], results["x"], results["fun"])
         print(a1, a2, b)
         print(np.unique(resp))
 
@@ -112,9 +119,9 @@ def fit_dbm(d, model_func, side, k, n, model_name):
         tmp = pd.DataFrame(results["x"])
         tmp.columns = ["p"]
         tmp["nll"] = results["fun"]
-        tmp["bic"] = k[m] * np.log(n) + 2 * results["fun"]
-        # tmp['aic'] = k[m] * 2 + 2 * results['fun']
-        tmp["model"] = model_name[m]
+        tmp["bic"] = DBM_K[m] * np.log(n) + 2 * results["fun"]
+        # tmp['aic'] = DBM_K[m] * 2 + 2 * results['fun']
+        tmp["model"] = DBM_MODEL_NAMES[m]
         drec.append(tmp)
 
     drec = pd.concat(drec)
@@ -122,7 +129,18 @@ def fit_dbm(d, model_func, side, k, n, model_name):
     return drec
 
 
-def nll_unix(params, *args):
+@njit(cache=True, fastmath=True, nogil=True)
+def norm_cdf(z):
+    """
+    - standard normal cdf written with math.erf so that it can be
+      called from inside the jitted nll functions
+    """
+
+    return 0.5 * (1.0 + math.erf(z / math.sqrt(2.0)))
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def nll_unix(params, z_limit, cat, x, y, resp, side):
     """
     - returns the negative loglikelihood of the unidimensional X bound fit
     - params format:  [bias noise] (so x=bias is boundary)
@@ -133,36 +151,28 @@ def nll_unix(params, *args):
     xc = params[0]
     noise = params[1]
 
-    z_limit = args[0]
-    cat = args[1]
-    x = args[2]
-    y = args[3]
-    resp = args[4]
-    side = args[5]
+    nll = 0.0
+    for i in range(x.shape[0]):
+        zscoreX = (x[i] - xc) / noise
+        zscoreX = min(max(zscoreX, -z_limit), z_limit)
 
-    n = x.shape[0]
-    A_indices = np.where(resp == 0)
-    B_indices = np.where(resp == 1)
-
-    zscoresX = (x - xc) / noise
-    zscoresX = np.clip(zscoresX, -z_limit, z_limit)
+        if side == 0:
+            prA = norm_cdf(zscoreX)
+            prB = 1 - prA
+        else:
+            prB = norm_cdf(zscoreX)
+            prA = 1 - prB
 
-    if side == 0:
-        prA = norm.cdf(zscoresX, 0.0, 1.0)
-        prB = 1 - prA
-    else:
-        prB = norm.cdf(zscoresX, 0.0, 1.0)
-        prA = 1 - prB
-
-    log_A_probs = np.log(prA[A_indices])
-    log_B_probs = np.log(prB[B_indices])
-
-    nll = -(np.sum(log_A_probs) + sum(log_B_probs))
+        if resp[i] == 0:
+            nll -= math.log(prA)
+        elif resp[i] == 1:
+            nll -= math.log(prB)
 
     return nll
 
 
-def nll_uniy(params, *args):
+@njit(cache=True, fastmath=True, nogil=True)
+def nll_uniy(params, z_limit, cat, x, y, resp, side):
     """
     - returns the negative loglikelihood of the unidimensional Y bound fit
     - params format:  [bias noise] (so y=bias is boundary)
@@ -173,36 +183,28 @@ def nll_uniy(params, *args):
     yc = params[0]
     noise = params[1]
 
-    z_limit = args[0]
-    cat = args[1]
-    x = args[2]
-    y = args[3]
-    resp = args[4]
-    side = args[5]
-
-    n = x.shape[0]
-    A_indices = np.where(resp == 0)
-    B_indices = np.where(resp == 1)
-
-    zscoresY = (y - yc) / noise
-    zscoresY = np.clip(zscoresY, -z_limit, z_limit)
+    nll = 0.0
+    for i in range(y.shape[0]):
+        zscoreY = (y[i] - yc) / noise
+        zscoreY = min(max(zscoreY, -z_limit), z_limit)
 
-    if side == 0:
-        prA = norm.cdf(zscoresY, 0.0, 1.0)
-        prB = 1 - prA
-    else:
-        prB = norm.cdf(zscoresY, 0.0, 1.0)
-        prA = 1 - prB
+        if side == 0:
+            prA = norm_cdf(zscoreY)
+            prB = 1 - prA
+        else:
+            prB = norm_cdf(zscoreY)
+            prA = 1 - prB
 
-    log_A_probs = np.log(prA[A_indices])
-    log_B_probs = np.log(prB[B_indices])
-
-    nll = -(np.sum(log_A_probs) + sum(log_B_probs))
+        if resp[i] == 0:
+            nll -= math.log(prA)
+        elif resp[i] == 1:
+            nll -= math.log(prB)
 
     return nll
 
 
-def nll_glc(params, *args):
+@njit(cache=True, fastmath=True, nogil=True)
+def nll_glc(params, z_limit, cat, x, y, resp, side):
     """
     - returns the negative loglikelihood of the GLC
     - params format: [a1 b noise]
@@ -215,39 +217,64 @@ def nll_glc(params, *args):
     """
 
     a1 = params[0]
-    a2 = np.sqrt(1 - params[0]**2)
+    a2 = math.sqrt(1 - params[0]**2)
     b = params[1]
     noise = params[2]
 
-    z_limit = args[0]
-    cat = args[1]
-    x = args[2]
-    y = args[3]
-    resp = args[4]
-    side = args[5]
+    nll = 0.0
+    for i in range(x.shape[0]):
+        zscore = (a1 * x[i] + a2 * y[i] + b) / noise
+        zscore = min(max(zscore, -z_limit), z_limit)
 
-    n = x.shape[0]
-    A_indices = np.where(resp == 0)
-    B_indices = np.where(resp == 1)
+        if side == 0:
+            prA = norm_cdf(zscore)
+            prB = 1 - prA
+        else:
+            prB = norm_cdf(zscore)
+            prA = 1 - prB
 
-    z_coefs = np.array([[a1, a2, b]]).T / params[2]
-    data_info = np.array([x, y, np.ones(np.shape(x))]).T
-    zscores = np.dot(data_info, z_coefs)
-    zscores = np.clip(zscores, -z_limit, z_limit)
+        if resp[i] == 0:
+            nll -= math.log(prA)
+        elif resp[i] == 1:
+            nll -= math.log(prB)
 
-    if side == 0:
-        prA = norm.cdf(zscores)
-        prB = 1 - prA
-    else:
-        prB = norm.cdf(zscores)
-        prA = 1 - prB
+    return nll
 
-    log_A_probs = np.log(prA[A_indices])
-    log_B_probs = np.log(prB[B_indices])
 
-    nll = -(np.sum(log_A_probs) + np.sum(log_B_probs))
+def make_nll_batch(nll):
+    """
+    - returns a jitted version of nll that evaluates a whole population
+    - params format: (n_params, n_population), as passed by
+      differential_evolution when vectorized=True
+    """
 
-    return nll
+    @njit(cache=True, fastmath=True, nogil=True)
+    def nll_batch(params, z_limit, cat, x, y, resp, side):
+        out = np.empty(params.shape[1])
+        for j in range(params.shape[1]):
+            out[j] = nll(params[:, j], z_limit, cat, x, y, resp, side)
+        return out
+
+    return nll_batch
+
+
+nll_unix_batch = make_nll_batch(nll_unix)
+nll_uniy_batch = make_nll_batch(nll_uniy)
+nll_glc_batch = make_nll_batch(nll_glc)
+
+# NOTE: decision-bound models fit to every subject x day
+DBM_MODELS = (nll_unix_batch, nll_unix_batch, nll_uniy_batch, nll_uniy_batch,
+              nll_glc_batch, nll_glc_batch)
+DBM_SIDE = (0, 1, 0, 1, 0, 1)
+DBM_K = (2, 2, 2, 2, 3, 3)
+DBM_MODEL_NAMES = (
+    "nll_unix_0",
+    "nll_unix_1",
+    "nll_uniy_0",
+    "nll_uniy_1",
+    "nll_glc_0",
+    "nll_glc_1",
+)
 
 
 def nll_gcc_eq(params, *args):
@@ -406,3 +433,15 @@ def val_glc(params, *args):
     resp = resp.astype(int)
 
     return cat, x, y, resp
+
+
+# NOTE: warm the jitted nll funcs once at import so that compilation (or
+#       loading from the on-disk cache) isn't paid inside the first fit
+_warm_args = (3, np.zeros(1, dtype=np.int64), np.zeros(1), np.zeros(1),
+              np.zeros(1, dtype=np.int64), 0)
+nll_unix(np.array([50.0, 1.0]), *_warm_args)
+nll_uniy(np.array([50.0, 1.0]), *_warm_args)
+nll_glc(np.array([0.0, 0.0, 1.0]), *_warm_args)
+nll_unix_batch(np.ones((2, 1)), *_warm_args)
+nll_uniy_batch(np.ones((2, 1)), *_warm_args)
+nll_glc_batch(np.ones((3, 1)) * 0.5, *_warm_args)
@@ -6,6 +6,9 @@ Maintains the original state-machine style and adds 'day' (repeated-measures).
 
 import os
 import sys
+import glob
+import csv
+import atexit
 import uuid
 from datetime import datetime
 import json
@@ -17,7 +20,7 @@ from util_func import *
 
 
 # --------------------------- EEG (Parallel Port) helper ---------------------------
-# Flip-locked rising edges; non-blocking clear to zero a few ms later.
+# Flip-locked rising edges; flip-locked clear to zero a whole number of frames later.
 EEG_ENABLED = False
 EEG_PORT_ADDRESS = '0x3FD8'
 EEG_DEFAULT_PULSE_MS = 10
@@ -57,6 +60,14 @@ TRIG = {
     "FB_INC_PROBE": 43,
 }
 
+# key lists polled in the main loop (built once rather than every frame)
+START_KEYS = ('space', )
+RESP_KEYS = ('d', 'k')
+
+# NOTE: the port takes one byte, so the codes are masked once here rather
+#       than on every pulse
+TRIG = {k: v & 0xFF for k, v in TRIG.items()}
+
 
 class EEGPort:
 
@@ -64,53 +75,55 @@ class EEGPort:
                  win,
                  address=EEG_PORT_ADDRESS,
                  enabled=EEG_ENABLED,
-                 default_ms=EEG_DEFAULT_PULSE_MS):
+                 default_ms=EEG_DEFAULT_PULSE_MS,
+                 flip_rate=60.0):
         self.win = win
         self.enabled = enabled
         self.default_ms = default_ms
+        self.flip_rate = flip_rate
         self._port = None
-        self._clear_at = None
-        if not self.enabled:
-            return
-        try:
-            from psychopy import parallel  # type: ignore
-            self._port = parallel.ParallelPort(address=address)
-        except Exception as e:
-            print(
-                f"[EEG] Parallel port unavailable ({e}). Running without triggers."
-            )
-            self.enabled = False
-            self._port = None
-
-    def flip_pulse(self, code, width_ms=None, global_clock=None):
-        """Schedule a flip-locked pulse: set code on next win.flip, clear after width_ms."""
-        if not (self.enabled and self._port):
-            return
+        # frames (i.e., update calls) left until the port is cleared
+        self._clear_frames = 0
+        if self.enabled:
+            try:
+                from psychopy import parallel  # type: ignore
+                self._port = parallel.ParallelPort(address=address)
+            except Exception as e:
+                print(
+                    f"[EEG] Parallel port unavailable ({e}). Running without triggers."
+                )
+                self.enabled = False
+                self._port = None
+        if self.enabled:
+            self._setData = self._port.setData
+        else:
+            # NOTE: shadow the per-frame / per-event methods with no-ops so
+            #       the methods below never need to check for a port
+            self.flip_pulse = self.pulse_now = lambda *a, **k: None
+            self.update = lambda: None
+
+    def _width_frames(self, width_ms):
         width_ms = self.default_ms if width_ms is None else width_ms
+        return max(1, int(round(width_ms * self.flip_rate / 1000.0)))
+
+    def flip_pulse(self, code, width_ms=None):
+        """Schedule a flip-locked pulse: set code on next win.flip, clear on the flip width_ms (in frames) later."""
         # rising edge exactly on next flip:
-        self.win.callOnFlip(self._port.setData, int(code) & 0xFF)
-        # schedule a timed clear to 0 after the flip:
-        if global_clock is not None:
-            # record when to clear (relative to global clock)
-            self._clear_at = global_clock.getTime() + (width_ms / 1000.0)
+        self.win.callOnFlip(self._setData, int(code))
+        self._clear_frames = self._width_frames(width_ms)
 
-    def pulse_now(self, code, width_ms=None, global_clock=None):
+    def pulse_now(self, code, width_ms=None):
         """Immediate pulse (not flip-locked) -- useful for response events."""
-        if not (self.enabled and self._port):
-            return
-        width_ms = self.default_ms if width_ms is None else width_ms
-        self._port.setData(int(code) & 0xFF)
-        if global_clock is not None:
-            self._clear_at = global_clock.getTime() + (width_ms / 1000.0)
-
-    def update(self, global_clock=None):
-        """Call every frame: clears the port to 0 if a pulse has expired."""
-        if not (self.enabled and self._port):
-            return
-        if self._clear_at is not None and global_clock is not None:
-            if global_clock.getTime() >= self._clear_at:
-                self._port.setData(0)
-                self._clear_at = None
+        self._setData(int(code))
+        self._clear_frames = self._width_frames(width_ms)
+
+    def update(self):
+        """Call once per frame: clears the port to 0 on the flip that ends a pulse."""
+        if self._clear_frames:
+            self._clear_frames -= 1
+            if not self._clear_frames:
+                # falling edge exactly on next flip:
+                self.win.callOnFlip(self._setData, 0)
 
     def close(self):
         try:
@@ -120,6 +133,12 @@ class EEGPort:
             pass
 
 
+def count_existing_rows(path):
+    """Number of trial rows (lines after the header) in an existing data file."""
+    with open(path, 'rb') as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+
 # ----------------------------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -160,10 +179,13 @@ if __name__ == "__main__":
     prefix = f"sub_{subject}_date_{today_key}_"
     suffix = "_data.csv"
 
-    existing = [
-        fn for fn in os.listdir(dir_data)
-        if fn.startswith(prefix) and fn.endswith(suffix)
-    ]
+    # NOTE: the prefix and suffix share the underscore before "data" in
+    #       today's file name, so the suffix is checked on the glob matches
+    #       rather than put in the pattern
+    existing = sorted(
+        os.path.basename(fn)
+        for fn in glob.glob(os.path.join(dir_data, prefix + "*"))
+        if fn.endswith(suffix))
 
     if len(existing) > 1:
         print("Multiple data files found for today:")
@@ -176,8 +198,8 @@ if __name__ == "__main__":
         f_name = existing[0]
         full_path = os.path.join(dir_data, f_name)
         try:
-            n_done = pd.read_csv(full_path).shape[0]
-        except Exception:
+            n_done = count_existing_rows(full_path)
+        except OSError:
             print(f"Could not read existing file: {f_name}. Aborting.")
             sys.exit()
     else:
@@ -199,21 +221,54 @@ if __name__ == "__main__":
     n_stimuli_per_category = n_total // 2
     ds, ds_90, ds_180 = make_stim_cats(n_stimuli_per_category)
 
-    ds_train = ds.copy()
-    ds_train = ds_train.sample(frac=1).reset_index(drop=True)
-    ds_train = ds_train.iloc[:n_train, :]
-    ds_train["phase"] = "train"
-
     if condition == 90:
-        ds_test = ds_90.copy()
+        ds_test = ds_90
     elif condition == 180:
-        ds_test = ds_180.copy()
-
-    ds_test = ds_test.sample(frac=1).reset_index(drop=True)
-    ds_test = ds_test.iloc[:n_test, :]
-    ds_test["phase"] = "test"
-
-    ds = pd.concat([ds_train, ds_test]).reset_index(drop=True)
+        ds_test = ds_180
+
+    rng = np.random.default_rng()
+
+    # NOTE: the train and test trials are drawn as shuffled row indices and
+    #       the trial columns are pulled out as numpy arrays once, so the main
+    #       loop indexes plain arrays rather than paying for pandas .iloc per
+    #       trial
+    train_idx = rng.permutation(ds.shape[0])[:n_train]
+    test_idx = rng.permutation(ds_test.shape[0])[:n_test]
+
+    def trial_col(col):
+        return np.concatenate(
+            [ds[col].to_numpy()[train_idx], ds_test[col].to_numpy()[test_idx]])
+
+    cat_arr = trial_col('cat')
+    x_arr = trial_col('x')
+    y_arr = trial_col('y')
+    xt_arr = trial_col('xt')
+    yt_arr = trial_col('yt')
+    phase_arr = np.repeat(['train', 'test'], [n_train, n_test])
+
+    # NOTE: pre-sample the 200-400 ms jitters that follow the ITI, the
+    #       response and the feedback on every trial
+    jitters = rng.integers(200, 401, size=(n_total, 3))
+
+    # NOTE: a trial's trigger codes only depend on its phase and category (and
+    #       on the response / feedback), so they are looked up once per trial
+    #       here rather than branched on in the state machine
+    is_train = phase_arr == 'train'
+    is_cat_a = cat_arr == "A"
+    stim_trig_arr = np.where(
+        is_train,
+        np.where(is_cat_a, TRIG["STIM_ONSET_A_TRAIN"],
+                 TRIG["STIM_ONSET_B_TRAIN"]),
+        np.where(is_cat_a, TRIG["STIM_ONSET_A_PROBE"],
+                 TRIG["STIM_ONSET_B_PROBE"]))
+    resp_a_trig_arr = np.where(is_train, TRIG["RESP_A_TRAIN"],
+                               TRIG["RESP_A_PROBE"])
+    resp_b_trig_arr = np.where(is_train, TRIG["RESP_B_TRAIN"],
+                               TRIG["RESP_B_PROBE"])
+    fb_cor_trig_arr = np.where(is_train, TRIG["FB_COR_TRAIN"],
+                               TRIG["FB_COR_PROBE"])
+    fb_inc_trig_arr = np.where(is_train, TRIG["FB_INC_TRAIN"],
+                               TRIG["FB_INC_PROBE"])
 
     # NOTE: Uncomment to visualize stimulus space scatter
     # import matplotlib.pyplot as plt
@@ -231,6 +286,11 @@ if __name__ == "__main__":
     size_cm = 5
     size_px = int(size_cm * px_per_cm)
 
+    # NOTE: convert every trial's stimulus to grating units up front
+    #       (spatial frequency in cycles / pix, orientation in degrees)
+    sf_pix_arr = xt_arr / px_per_cm
+    ori_deg_arr = yt_arr * (180.0 / np.pi)
+
     win = visual.Window(size=(1920, 1080),
                         fullscr=True,
                         units='pix',
@@ -276,7 +336,8 @@ if __name__ == "__main__":
                                  size=(size_px, size_px),
                                  units='pix',
                                  sf=0.02,
-                                 ori=0.0)
+                                 ori=0.0,
+                                 pos=(center_x, center_y))
 
     fb_ring = visual.Circle(win,
                             radius=(size_px // 2 + 10),
@@ -288,48 +349,94 @@ if __name__ == "__main__":
                             pos=(center_x, center_y))
 
     kb = keyboard.Keyboard()
-    default_kb = keyboard.Keyboard()
 
-    global_clock = core.Clock()
     state_clock = core.Clock()
     stim_clock = core.Clock()
 
     # --------------------------- EEG init ----------------------------------------
-    eeg = EEGPort(win)
+    # NOTE: getActualFrameRate returns None if it can't measure a stable rate
+    eeg = EEGPort(win, flip_rate=frame_rate or 60.0)
 
     # --------------------------- State machine setup ------------------------------
     time_state = 0.0
     state_current = "state_init"
     state_entry = True
 
+    # NOTE: what each state draws every frame. The state logic below only
+    #       updates state, and the draw + flip for the frame happen once
+    #       after it. state_jitter's entry is filled in on the way into a
+    #       jitter so the previous screen stays up.
+    state_draw = {
+        "state_init": (init_text, ),
+        "state_finished": (finished_text, ),
+        "state_iti": (fix_h, fix_v),
+        "state_stim": (grating, ),
+        "state_feedback": (grating, fb_ring),
+        "state_jitter": (),
+    }
+
+    # NOTE: jitters between states run in state_jitter, which waits
+    #       jitter_ms and then moves on to state_next
+    state_next = None
+    jitter_ms = 0
+
     resp = -1
     rt = -1
-    trial = -1
 
     # Record keeping
-    trial_data = {
-        'subject': [],
-        'day': [],
-        'trial': [],
-        'cat': [],
-        'x': [],
-        'y': [],
-        'xt': [],
-        'yt': [],
-        'resp': [],
-        'rt': [],
-        'fb': []
-    }
+    # NOTE: each trial is appended to the csv as a single row rather than
+    #       rewriting the whole file after every trial, and a resumed session
+    #       appends to today's file after its n_done rows
+    # NOTE: the session date stands in for the day index
+    day = today_key
+    trial_cols = [
+        'subject', 'day', 'trial', 'cat', 'x', 'y', 'xt', 'yt', 'resp', 'rt',
+        'fb'
+    ]
+    # NOTE: open() with an explicit buffering size wraps the file in a
+    #       64 KiB BufferedWriter, so rows only reach the OS when flushed
+    csv_f = open(full_path, 'a', newline='', buffering=1 << 16)
+    csv_w = csv.writer(csv_f)
+    if csv_f.tell() == 0:
+        csv_w.writerow(trial_cols)
+
+    # NOTE: rows are held in memory and written out every n_flush trials (and
+    #       at the end of the session or on exit) so the file is not touched
+    #       after every trial
+    n_flush = 10
+    pending_rows = []
+
+    def flush_rows():
+        if pending_rows:
+            csv_w.writerows(pending_rows)
+            csv_f.flush()
+            pending_rows.clear()
+
+    atexit.register(flush_rows)
+
+    # NOTE: everything but the response is known before the session starts,
+    #       so each trial's record is prebuilt and only resp / rt / fb are
+    #       added as trials complete
+    trial_stim = [(subject, day, t, c, x, y, xt, yt)
+                  for t, (c, x, y, xt, yt) in enumerate(
+                      zip(cat_arr, x_arr, y_arr, xt_arr, yt_arr))]
 
     # --------------------------- Main loop ---------------------------------------
     running = True
+
+    # NOTE: escape is a psychopy global key, checked by the window during
+    #       win.flip(), so the loop itself doesn't poll for it
+    def stop_running():
+        global running
+        running = False
+
+    event.globalKeys.add(key='escape', func=stop_running)
+
     while running:
 
-        if default_kb.getKeys(keyList=['escape'], waitRelease=False):
-            running = False
-            break
+        eeg.update()
 
-        eeg.update(global_clock)
+        state_drawn = state_current
 
         # --------------------- STATE: INIT ---------------------
         if state_current == "state_init":
@@ -339,39 +446,33 @@ if __name__ == "__main__":
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
-            init_text.draw()
 
-            keys = kb.getKeys(keyList=['space'], waitRelease=False, clear=True)
+            keys = kb.getKeys(keyList=START_KEYS,
+                              waitRelease=False,
+                              clear=True)
             if keys:
-                eeg.flip_pulse(TRIG["EXP_START"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG["EXP_START"])
                 state_current = "state_iti"
                 state_entry = True
 
-            win.flip()
-
         # --------------------- STATE: FINISHED ---------------------
         elif state_current == "state_finished":
             if state_entry:
-                eeg.flip_pulse(TRIG["EXP_END"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG["EXP_END"])
                 state_clock.reset()
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
-            finished_text.draw()
-            win.flip()
 
         # --------------------- STATE: ITI ---------------------
         elif state_current == "state_iti":
             if state_entry:
                 state_clock.reset()
-                eeg.flip_pulse(TRIG["ITI_ONSET"], global_clock=global_clock)
+                eeg.flip_pulse(TRIG["ITI_ONSET"])
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
 
-            fix_h.draw()
-            fix_v.draw()
-
             if time_state > 1000:
                 resp = -1
                 rt = -1
@@ -381,39 +482,26 @@ if __name__ == "__main__":
                     state_current = "state_finished"
                     state_entry = True
                 else:
-                    sf_cycles_per_cm = ds['xt'].iloc[trial]
-                    sf_cycles_per_pix = sf_cycles_per_cm / px_per_cm
-                    ori_deg = ds['yt'].iloc[trial] * 180.0 / np.pi
-                    cat = ds['cat'].iloc[trial]
-
-                    grating.sf = sf_cycles_per_pix
-                    grating.ori = ori_deg
-                    grating.pos = (center_x, center_y)
+                    grating.sf = sf_pix_arr[trial]
+                    grating.ori = ori_deg_arr[trial]
 
                     kb.clearEvents()
-                    state_current = "state_stim"
+                    state_current = "state_jitter"
+                    state_next = "state_stim"
+                    state_draw["state_jitter"] = state_draw["state_iti"]
+                    jitter_ms = jitters[trial, 0]
                     state_entry = True
 
-                    jitter = np.random.randint(200, 401)
-                    core.wait(jitter / 1000.0)
-
-            win.flip()
-
         # --------------------- STATE: STIM ---------------------
         elif state_current == "state_stim":
             if state_entry:
-                if ds['phase'].iloc[trial] == 'train':
-                    if cat == "A":
-                        trig = TRIG["STIM_ONSET_A_TRAIN"]
-                    else:
-                        trig = TRIG["STIM_ONSET_B_TRAIN"]
-                elif ds['phase'].iloc[trial] == 'test':
-                    if cat == "A":
-                        trig = TRIG["STIM_ONSET_A_PROBE"]
-                    else:
-                        trig = TRIG["STIM_ONSET_B_PROBE"]
-
-                eeg.flip_pulse(trig, global_clock=global_clock)
+                eeg.flip_pulse(stim_trig_arr[trial])
+
+                # NOTE: bind this trial's category and response triggers once
+                #       so the per-frame response poll only touches locals
+                trial_cat = cat_arr[trial]
+                trig_resp_a = resp_a_trig_arr[trial]
+                trig_resp_b = resp_b_trig_arr[trial]
 
                 state_clock.reset()
                 stim_clock.reset()
@@ -423,32 +511,18 @@ if __name__ == "__main__":
 
             time_state = state_clock.getTime() * 1000.0
 
-            grating.draw()
-
-            keys = kb.getKeys(keyList=['d', 'k'], waitRelease=False)
+            keys = kb.getKeys(keyList=RESP_KEYS, waitRelease=False, clear=True)
             if keys:
                 k = keys[-1]
                 rt = k.rt * 1000.0
-                if ds['phase'].iloc[trial] == 'train':
-                    if k.name == 'd':
-                        resp_label = "A"
-                        eeg.pulse_now(TRIG["RESP_A_TRAIN"],
-                                      global_clock=global_clock)
-                    else:
-                        resp_label = "B"
-                        eeg.pulse_now(TRIG["RESP_B_TRAIN"],
-                                      global_clock=global_clock)
-                elif ds['phase'].iloc[trial] == 'test':
-                    if k.name == 'd':
-                        resp_label = "A"
-                        eeg.pulse_now(TRIG["RESP_A_PROBE"],
-                                      global_clock=global_clock)
-                    else:
-                        resp_label = "B"
-                        eeg.pulse_now(TRIG["RESP_B_PROBE"],
-                                      global_clock=global_clock)
-
-                if cat == resp_label:
+                if k.name == 'd':
+                    resp_label = "A"
+                    eeg.pulse_now(trig_resp_a)
+                else:
+                    resp_label = "B"
+                    eeg.pulse_now(trig_resp_b)
+
+                if trial_cat == resp_label:
                     fb = "Correct"
                 else:
                     fb = "Incorrect"
@@ -456,70 +530,63 @@ if __name__ == "__main__":
                 resp = resp_label
 
                 state_clock.reset()
-                state_current = "state_feedback"
+                state_current = "state_jitter"
+                state_next = "state_feedback"
+                state_draw["state_jitter"] = state_draw["state_stim"]
+                jitter_ms = jitters[trial, 1]
                 state_entry = True
 
-                jitter = np.random.randint(200, 401)
-                core.wait(jitter / 1000.0)
-
-            win.flip()
-
         # --------------------- STATE: FEEDBACK ---------------------
         elif state_current == "state_feedback":
             if state_entry:
-                if ds['phase'].iloc[trial] == 'train':
-                    if fb == "Correct":
-                        fb_ring.lineColor = 'green'
-                        eeg.flip_pulse(TRIG["FB_COR_TRAIN"],
-                                       global_clock=global_clock)
-                    else:
-                        fb_ring.lineColor = 'red'
-                        eeg.flip_pulse(TRIG["FB_INC_TRAIN"],
-                                       global_clock=global_clock)
-                elif ds['phase'].iloc[trial] == 'test':
-                    if fb == "Correct":
-                        fb_ring.lineColor = 'green'
-                        eeg.flip_pulse(TRIG["FB_COR_PROBE"],
-                                       global_clock=global_clock)
-                    else:
-                        fb_ring.lineColor = 'red'
-                        eeg.flip_pulse(TRIG["FB_INC_PROBE"],
-                                       global_clock=global_clock)
+                if fb == "Correct":
+                    fb_ring.lineColor = 'green'
+                    eeg.flip_pulse(fb_cor_trig_arr[trial])
+                else:
+                    fb_ring.lineColor = 'red'
+                    eeg.flip_pulse(fb_inc_trig_arr[trial])
 
                 state_clock.reset()
                 state_entry = False
 
             time_state = state_clock.getTime() * 1000.0
 
-            grating.draw()
-            fb_ring.draw()
-
             if time_state > 1000:
-                trial_data['subject'].append(subject)
-                trial_data['day'].append(day)
-                trial_data['trial'].append(trial)
-                trial_data['cat'].append(ds['cat'].iloc[trial])
-                trial_data['x'].append(ds['x'].iloc[trial])
-                trial_data['y'].append(ds['y'].iloc[trial])
-                trial_data['xt'].append(ds['xt'].iloc[trial])
-                trial_data['yt'].append(ds['yt'].iloc[trial])
-                trial_data['resp'].append(resp)
-                trial_data['rt'].append(rt)
-                trial_data['fb'].append(fb)
-
-                pd.DataFrame(trial_data).to_csv(full_path, index=False)
-
-                state_current = "state_iti"
+                pending_rows.append(trial_stim[trial] + (resp, rt, fb))
+                if len(pending_rows) >= n_flush or trial == n_total - 1:
+                    flush_rows()
+
+                state_current = "state_jitter"
+                state_next = "state_iti"
+                state_draw["state_jitter"] = state_draw["state_feedback"]
+                jitter_ms = jitters[trial, 2]
                 state_entry = True
                 resp = -1
                 rt = -1
 
-                jitter = np.random.randint(200, 401)
-                core.wait(jitter / 1000.0)
+        # --------------------- STATE: JITTER ---------------------
+        # NOTE: non-blocking 200-400 ms wait that keeps the previous screen
+        #       up while EEG pulses are cleared and escape stays responsive
+        elif state_current == "state_jitter":
+            if state_entry:
+                state_clock.reset()
+                state_entry = False
+
+            time_state = state_clock.getTime() * 1000.0
+
+            if time_state >= jitter_ms:
+                state_current = state_next
+                state_entry = True
+
+        # --------------------- DRAW + FLIP ---------------------
+        for stim in state_draw[state_drawn]:
+            stim.draw()
 
-            win.flip()
+        win.flip()
 
     # --------------------------- Cleanup ------------------------------------------
     eeg.close()
+    flush_rows()
+    csv_f.close()
     win.close()
     core.quit()